@@ -1,19 +1,56 @@
 from pathlib import Path
+import json
+import re
 from datetime import datetime, timedelta, tzinfo, timezone
-from itertools import *
+from functools import lru_cache
 
-from influxdb import InfluxDBClient, DataFrameClient
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from collections.abc import Sequence
+from matplotlib.collections import PolyCollection
+from collections.abc import Mapping, Sequence, Set
 from scipy import integrate
 
 
+# Container types accepted wherever several fields or key values may be passed
+_SEQ_TYPES = (list, tuple, set, frozenset)
+
+# Numpy dtypes of InfluxDB field types, of timestamps and of values with unknown type
+_TYPE_CONVERSION = {'integer': np.dtype('int64'), 'float': np.dtype('float64'), 'string': np.dtype('O'),
+                    'boolean': np.dtype('bool')}
+_TIME_TYPE = np.dtype('<M8[ns]')
+_DEFAULT_TYPE = np.dtype('O')
+_STRING_TYPE = np.dtype('U')
+
+# pandas >= 2 infers a single format from the first timestring, while InfluxDB omits trailing
+#   zeros of fractional seconds, so mixed ISO 8601 precision has to be requested explicitly.
+_ISO8601 = {'format': 'ISO8601'} if int(pd.__version__.split('.')[0]) >= 2 else {}
+
+
+def _is_sequence(value):
+    # Builtin containers are matched directly, other sequences and sets through the ABCs (except strings)
+    return isinstance(value, _SEQ_TYPES) or (isinstance(value, (Sequence, Set))
+                                             and not isinstance(value, (str, bytes)))
+
+
+@lru_cache(maxsize=64, typed=True)
+def _to_timedelta(value):
+    # Timedelta parsing is slow compared to the calculations that use it, and the same few
+    #   values (e.g. '1h', '6h') are passed over and over, so conversions are cached.
+    return pd.Timedelta(value).asm8
+
+
+@lru_cache(maxsize=64, typed=True)
+def _to_minutes(value):
+    return _to_timedelta(value).astype('<m8[m]')
+
+
 class DBQuery():
     """Class to access InfluxDB 1.x and select records from it."""
 
-    def __init__(self, database, username, password, host='localhost', port=8086):
+    def __init__(self, database, username, password, host='localhost', port=8086, chunk_size=10000):
         """
         :type database: str
         :param database: Name of the database.
@@ -29,22 +66,123 @@ class DBQuery():
 
         :type port: int, optional
         :param port: Connection port, defaults to ``8086``.
+
+        :type chunk_size: int, optional
+        :param chunk_size: Number of records InfluxDB sends in each chunk of a streamed
+            response, defaults to ``10000``.
+            Smaller chunks lower peak memory usage of :func:`get_data`, larger chunks
+            reduce per-chunk overhead.
         """
         self.database = database
         self.username = username
         self.password = password
         self.host = host
         self.port = port
+        self.chunk_size = chunk_size
         self.client = InfluxDBClient(host=self.host,
                                      port=self.port,
                                      username=self.username,
                                      password=self.password,
                                      database=self.database)
+        # Tag names, field names and field types for each series, see __get_schema()
+        self._schema_cache = {}
+
+
+    def close(self):
+        """Close the connection to the database.
+
+        The connection is also closed when the object is used as a context manager
+        (``with DBQuery(...) as client:``) or garbage collected.
+        Calling this method more than once has no effect.
+        """
+        if getattr(self, 'client', None) is not None:
+            self.client.close()
+            self.client = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
     def __del__(self):
-        print("Existing connection closed.")
-        self.client.close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+    def __show(self, *queries):
+        # Send all (SHOW) queries in a single request and return the list of rows
+        #   for each of them, empty if the query does not return any values.
+        results = self.client.query(' '.join(queries))
+        if len(queries) == 1:
+            results = [results]
+        rows = []
+        for result in results:
+            series = result.raw.get('series')
+            rows.append(series[0]['values'] if series else [])
+        return rows
+
+
+    def __select(self, query, bind_params):
+        # Stream the response in chunks and yield the series entries of each of them (with
+        #   epoch-ns timestamps). InfluxDBClient.query(chunked=True) keeps only the list values
+        #   of a chunk, so a statement error (sent with HTTP 200) would be silently dropped.
+        params = {'q': query, 'db': self.database, 'params': json.dumps(bind_params), 'epoch': 'ns',
+                  'chunked': 'true', 'chunk_size': self.chunk_size}
+        # The client asks for msgpack by default, but a chunked msgpack body is a sequence of
+        #   documents that the client would try to unpack (and read) as a single one. JSON
+        #   chunks are sent one per line and can be parsed as they arrive.
+        headers = {**self.client._headers, 'Accept': 'application/json'}
+        response = self.client.request(url='query', method='GET', params=params, data=None, stream=True,
+                                       expected_response_code=200, headers=headers)
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    raise InfluxDBClientError(chunk['error'])
+                for result in chunk.get('results', []):
+                    if 'error' in result:
+                        raise InfluxDBClientError(result['error'])
+                    yield from result.get('series', [])
+        finally:
+            # The connection goes back to the pool only once the response is closed
+            response.close()
+
+
+    def __get_schema(self, series):
+        # Both SHOW queries are sent in a single request and the result is cached, so
+        #   repeated calls for the same series don't need any round-trips to the server.
+        if series not in self._schema_cache:
+            tags, fields = self.__show(f'SHOW TAG KEYS FROM "{series}";',
+                                       f'SHOW FIELD KEYS FROM "{series}";')
+            self._schema_cache[series] = (tuple(x[0] for x in tags),
+                                          tuple(x[0] for x in fields),
+                                          tuple(x[1] for x in fields))
+        return self._schema_cache[series]
+
+
+    def refresh_schema(self, series=None):
+        """Clear cached tag names, field names and field types.
+
+        The schema of a series is queried once and then reused by :func:`get_tags`,
+        :func:`get_fields` and :func:`get_data`.
+        Call this method if the schema was changed after it was first queried.
+
+        :type series: None|str, optional
+        :param series: Name of the series to clear the schema for, defaults to ``None``
+            (schemas of all series are cleared).
+        """
+        if series is None:
+            self._schema_cache.clear()
+        else:
+            self._schema_cache.pop(series, None)
 
 
     def get_measurements(self):
@@ -53,12 +191,8 @@ class DBQuery():
         :rtype: list[str]
         :return: List of all measurement names in the database.
         """
-        query = f"SHOW MEASUREMENTS;"
-        result = self.client.query(query).raw['series']
-        if result:
-            return [x[0] for x in result[0]['values']]
-        else:
-            return []
+        measurements, = self.__show("SHOW MEASUREMENTS;")
+        return [x[0] for x in measurements]
 
 
     def get_tags(self, series):
@@ -74,13 +208,10 @@ class DBQuery():
             Returns an empty list if the query does not return any vaues, for example,
             if there are no tags in the series or if there is no series with the
             given name.
+
+            The result is cached, see :func:`refresh_schema`.
         """
-        query = f'SHOW TAG KEYS FROM "{series}";'
-        result = self.client.query(query).raw['series']
-        if result:
-            return [x[0] for x in result[0]['values']]
-        else:
-            return []
+        return list(self.__get_schema(series)[0])
 
 
     def get_fields(self, series, return_types=False):
@@ -108,20 +239,14 @@ class DBQuery():
             Returns an empty list if the query does not return any vaues, for example,
             if there are no tags in the series or if there is no series with the
             given name.
-        """
 
-        query = f'SHOW FIELD KEYS FROM "{series}";'
-        result = self.client.query(query).raw['series']
-        if result:
-            if return_types:
-                return ([x[0] for x in result[0]['values']], [x[1] for x in result[0]['values']])
-            else:
-                return [x[0] for x in result[0]['values']]
+            The result is cached, see :func:`refresh_schema`.
+        """
+        _, fields, types = self.__get_schema(series)
+        if return_types:
+            return (list(fields), list(types))
         else:
-            if return_types:
-                return ([], [])
-            else:
-                return []
+            return list(fields)
 
 
     def get_keys(self, series, tag):
@@ -141,12 +266,8 @@ class DBQuery():
             if there are no tags in the series or if there is no series with the
             given name.
         """
-        query = f'SHOW TAG VALUES FROM "{series}" WITH KEY = "{str(tag)}";'
-        result = self.client.query(query).raw['series']
-        if result:
-            return [x[1] for x in result[0]['values']]
-        else:
-            return []
+        values, = self.__show(f'SHOW TAG VALUES FROM "{series}" WITH KEY = "{str(tag)}";')
+        return [x[1] for x in values]
 
 
     def get_data(self, series, fields, keys=None, start=None, stop=None, local_tz=False):
@@ -176,6 +297,9 @@ class DBQuery():
                 Use ``None`` as a field type to enable type autodetection and/or
                 avoid type conversion for that field.
 
+                If types are specified for all fields (and ``'*'`` is not used) then
+                the series schema is not queried and the types are used as is.
+
         :type keys: None|dict[str: obj], optional
         :param keys: Dictionary providing rules to select records with specific
             field/tag values, defaults to ``None``.
@@ -230,61 +354,81 @@ class DBQuery():
             Value
                 Numpy array of the corresponding field/tag values.
         """
+        # Local timezone is looked up once per query, not for each boundary
+        tz = datetime.now().astimezone().tzinfo if local_tz else 'UTC'
+
         def _tz_convert(t, local_tz=False):
             # Never adjust timezone for epoch timestamps
             if isinstance(t, int):
                 return t
-            tz = datetime.now().astimezone().tzinfo if local_tz else 'UTC'
+            if type(t) is datetime:
+                # Format datetime objects directly (RFC3339) without constructing Timestamps.
+                # Naive datetimes are treated as UTC or as local time (with the same offset as
+                #   timestrings and Timestamps).
+                if t.tzinfo is None:
+                    t = t.replace(tzinfo=tz if local_tz else timezone.utc)
+                return t.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
             t = pd.Timestamp(t)
             if t.tz:
                 # Always convert aware Timestamp to UTC timezone
-                return f"'{t.tz_convert(None)}'"
+                return str(t.tz_convert(None))
             else:
                 # Naive Timestamps can be treated as representing UTC or local time
-                return f"'{t.tz_localize(tz).tz_convert(None)}'"
+                return str(t.tz_localize(tz).tz_convert(None))
 
-        def _type_cast(value, dtype):
-            if dtype is None:
-                return value
+        def _type_cast(values, dtype):
+            # Values are converted column-wise, not one by one
             if dtype.kind == 'M':
-                return pd.Timestamp(value).tz_convert(None).asm8
+                if values and isinstance(values[0], int):
+                    # Epoch nanoseconds (the time column) are reinterpreted without any parsing
+                    values = np.fromiter(values, dtype='int64', count=len(values))
+                    return values.view('<M8[ns]').astype(dtype, copy=False)
+                values = pd.to_datetime(values, utc=True, cache=True, **_ISO8601).tz_convert(None)
+                # Parsed values already are datetime64[ns], so requesting the same dtype doesn't copy them
+                return values.values.astype(dtype, copy=False)
             if dtype.kind == 'm':
-                return pd.Timedelta(value).asm8
-            else:
-                return value
-
-        def _destructure(key, val):
-            if type(val) in (list, tuple, set):
-                destruct = [f"\"{key!s}\" = '{v!s}'" for v in val]
-                return f"({' OR '.join(destruct)})"
+                return pd.to_timedelta(values).values.astype(dtype, copy=False)
+            if dtype.kind in 'biuf':
+                # Numeric values are read straight into a preallocated array
+                return np.fromiter(values, dtype=dtype, count=len(values))
             else:
-                return f"(\"{key!s}\" = '{val!s}')"
-
-        time_type = np.dtype('<M8[ns]')
-        default_type = np.dtype('O')
-        type_conversion = {'integer': 'int64', 'float': 'float64', 'string': 'O', 'boolean': 'bool'}
-        ftypes = {'time': time_type}
-        dbtags = self.get_tags(series)
-        string_fields = dbtags
+                return np.asarray(values, dtype=dtype)
+
+        # Values are sent as bind parameters, so the query text only depends on the
+        #   names of keys and the number of their values.
+        bind_params = {}
+
+        ftypes = {'time': _TIME_TYPE}
+        if isinstance(fields, Mapping) and '*' not in fields and None not in fields.values():
+            # All types are known, there is no need to query (or cache) the schema. Without it
+            #   the string columns are the ones given the 'string' type.
+            dbtags, dbfields, dbtypes = (), (), ()
+            tag_keys = None
+            string_fields = {f for f, t in fields.items() if isinstance(t, str) and t == 'string'}
+        else:
+            dbtags, dbfields, dbtypes = self.__get_schema(series)
+            tag_keys = frozenset(dbtags)
+            string_fields = set(dbtags)
         for f in dbtags:
-            ftypes[f] = np.dtype('O')
-        dbfields, dbtypes = self.get_fields(series, return_types=True)
+            ftypes[f] = _DEFAULT_TYPE
         for f, t in zip(dbfields, dbtypes):
             if t == 'string':
-                string_fields += [f]
-            ftypes[f] = np.dtype(type_conversion[t])
-        dballf = dbfields + dbtags
-        if type(fields) is dict:
+                string_fields.add(f)
+            ftypes[f] = _TYPE_CONVERSION[t]
+        dballf = list(dbfields + dbtags)
+        if isinstance(fields, str):
+            fields = dballf if fields == '*' else [f'{fields!s}']
+        elif isinstance(fields, Mapping):
             _fields = []
             for f, t in fields.items():
                 if f == '*':
                     _fields += dballf
                 else:
                     if t is not None:
-                        ftypes[f] = np.dtype(type_conversion.get(t, t))
+                        ftypes[f] = _TYPE_CONVERSION[t] if t in _TYPE_CONVERSION else np.dtype(t)
                     _fields += [f'{f!s}']
             fields = _fields
-        elif type(fields) in (list, tuple, set):
+        elif _is_sequence(fields):
             _fields = []
             for f in fields:
                 if f == '*':
@@ -292,43 +436,81 @@ class DBQuery():
                 else:
                     _fields += [f'{f!s}']
             fields = _fields
-        elif type(fields) is str:
-            fields = dballf if fields == '*' else [f'{fields!s}']
         else:
             raise TypeError(f"fields should be a string, list, tuple, set or dict but {type(fields)} was passed")
         if 'time' not in fields:
             fields = ['time'] + fields
+        fields = list(dict.fromkeys(fields))
         for f in fields:
             if f not in ftypes:
-                ftypes[f] = default_type
-        if keys is None or keys == {}:
-            where_clause = ""
-        elif type(keys) is not dict:
+                ftypes[f] = _DEFAULT_TYPE
+        if keys is not None and not isinstance(keys, Mapping):
             raise ValueError(f"keys should be None or dic of key: value pairs but {type(keys)} was passed")
-        else:
-            where_clause = f" WHERE {' AND '.join([_destructure(k, v) for k, v in keys.items()])}"
-        time_query = ''
+        conditions = []
+        for idx, (k, v) in enumerate((keys or {}).items()):
+            is_sequence = _is_sequence(v)
+            if is_sequence and len(v) == 1:
+                v, = v
+                is_sequence = _is_sequence(v)
+            if (is_sequence and v and all(isinstance(_v, str) for _v in v)
+                    and (tag_keys is None or k in tag_keys)):
+                # Several string values of a tag are matched by a single anchored regex that
+                #   uses the tag index instead of an OR chain ('/' has to be escaped inside the
+                #   regex literal). Fields are not indexed, so they keep plain comparisons.
+                pattern = '|'.join(re.escape(_v).replace('/', r'\/') for _v in v)
+                conditions.append(f'("{k!s}" =~ /^({pattern})$/)')
+            elif is_sequence:
+                names = [f'k{idx}_{i}' for i in range(len(v))]
+                bind_params.update(zip(names, map(str, v)))
+                key = f'"{k!s}" = $'
+                conditions.append(f"({' OR '.join(key + name for name in names)})")
+            else:
+                bind_params[f'k{idx}'] = str(v)
+                conditions.append(f'("{k!s}" = $k{idx})')
         if start is not None:
-            time_query += f" AND time >= {_tz_convert(start, local_tz=local_tz)}"
+            bind_params['start'] = _tz_convert(start, local_tz=local_tz)
+            conditions.append("time >= $start")
         if stop is not None:
-            time_query += f" AND time < {_tz_convert(stop, local_tz=local_tz)}"
-        qfields = [f'"{f}"' for f in fields]
-        query = f'SELECT {", ".join(qfields)} FROM "{series}"{where_clause}{time_query};'
-        processed_query = self.client.query(query).raw['series']
-        result = {}
-        if processed_query:
-            data = processed_query[0]['values']
-            #fields = processed_query[0]['columns']
+            bind_params['stop'] = _tz_convert(stop, local_tz=local_tz)
+            conditions.append("time < $stop")
+        where_clause = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        if dballf and set(fields) == {'time', *dballf}:
+            # All columns of the series are selected, let the server enumerate them. Columns are
+            #   matched by name in the response, so their order doesn't matter.
+            qfields = '*'
         else:
-            data = []
-        for field in fields:
-            result[field] = np.zeros(len(data), dtype=ftypes[field])
-        for i, row in zip(count(), data):
-            for value, field in zip(row, fields):
-                result[field][i] = _type_cast(value, ftypes[field])
+            qfields = ', '.join(f'"{f}"' for f in fields)
+        query = f'SELECT {qfields} FROM "{series}"{where_clause};'
+        # String fields are converted straight to fixed-width unicode
+        dtypes = {f: _STRING_TYPE if f in string_fields else ftypes[f] for f in fields}
+        # The response is streamed in chunks and each chunk is converted column-wise, so the
+        #   whole result is never held in memory as Python objects.
+        chunks = {f: [] for f in fields}
+        # A chunk may contain several series entries (or none), each with its own columns
+        for processed_chunk in self.__select(query, bind_params):
+            if not processed_chunk.get('values'):
+                continue
+            columns = {c: i for i, c in enumerate(processed_chunk['columns'])}
+            # Rows -> tuples of column values, transposed in a single C-level pass
+            data = tuple(zip(*processed_chunk['values']))
+            for f in fields:
+                if f in columns:
+                    values = data[columns[f]]
+                else:
+                    # SELECT * only returns columns that exist in the queried time range, an
+                    #   explicit column list would return nulls for the rest
+                    values = (None,) * len(processed_chunk['values'])
+                chunks[f].append(_type_cast(values, dtypes[f]))
+        result = {}
         for f in fields:
-            if f in string_fields:
-                result[f] = result[f].astype('U')
+            if len(chunks[f]) == 1:
+                # Single chunk is already a final (fixed-width for strings) array, don't copy it
+                result[f] = chunks[f][0]
+            elif chunks[f]:
+                # Width of the resulting string array is the maximal width among the chunks
+                result[f] = np.concatenate(chunks[f])
+            else:
+                result[f] = np.zeros(0, dtype=dtypes[f])
         return result
 
 
@@ -392,6 +574,9 @@ class CycleAnalyzer():
     __minute = np.timedelta64(1, 'm')
     __hour = np.timedelta64(60, 'm')
     __day = np.timedelta64(60*24, 'm')
+    # Same lengths in minutes as plain integers, for arithmetic on integer views of time arrays
+    __hour_minutes = 60
+    __day_minutes = 60*24
 
 
     def __init__(self, timestamps, activity=None, night=None, step='1m', start=None, stop=None, descr='',
@@ -471,13 +656,14 @@ class CycleAnalyzer():
             raise ValueError(f"night should have same size as timestamps")
 
         # Check for valid step size
-        self.step = pd.Timedelta(step).asm8
+        self.step = _to_timedelta(step)
         if (self.step < self.__minute) or (self.step % self.__minute != self.__zero):
             raise ValueError(f"step must be a whole number of minutes")
         self.step = self.step.astype('<m8[m]')
         if self.__day % self.step != self.__zero:
             raise ValueError(f"day should be divisible by step size")
         self.steps_per_day = self.__day // self.step # Steps Per Day
+        self.__step_minutes = int(self.step.astype('int64'))
 
         # Handle start and stop positions
         self.start = timestamps[0]
@@ -498,9 +684,19 @@ class CycleAnalyzer():
         # Discretize data so it will be alingned to regular (uniform) 1D grid.
         # We need this step because input will have values only at points where activity > 0,
         #   thus distance between 2 consecutive input data points will vary.
-        intervals = np.arange(self.start, self.stop + self.step, self.step)
-        self.__timestamps = intervals[:-1]
-        self.__activity, _ = np.histogram(timestamps, intervals, weights=activity)
+        self.__timestamps = np.arange(self.start, self.stop, self.step)
+        # Bin indices of data points are calculated once and shared by activity, night and day binning.
+        #   Like np.histogram, the last bin also includes points exactly at its right edge.
+        # Indices are calculated on integer nanoseconds, which is faster than datetime arithmetic.
+        total_steps = self.__timestamps.size
+        ns = timestamps.astype('<M8[ns]', copy=False).view('int64')
+        start_ns = self.start.astype('<M8[ns]').astype('int64')
+        step_ns = self.step.astype('<m8[ns]').astype('int64')
+        bin_idx = (ns - start_ns) // step_ns
+        bin_idx[ns == start_ns + total_steps * step_ns] = total_steps - 1
+        in_range = (bin_idx >= 0) & (bin_idx < total_steps)
+        self.__activity = np.bincount(bin_idx[in_range], weights=activity[in_range],
+                                      minlength=total_steps).astype(activity.dtype, copy=False)
 
         # Here and later day and night refers to lights on/off conditions while calendar day refers to 24-hour
         #   calendar day.
@@ -518,10 +714,12 @@ class CycleAnalyzer():
         # Number of calendar days that follow each day/night pattern, sum(pattern_days) = self.total_days
         pattern_days = [0]
         self.__night = np.zeros(self.steps_per_day * self.total_days, dtype='bool')
-        night_array, _ = np.histogram(timestamps[night], intervals)
-        night_array = night_array.astype('bool').reshape(self.total_days, self.steps_per_day)
-        day_array, _ = np.histogram(timestamps[~night], intervals)
-        day_array = day_array.astype('bool').reshape(self.total_days, self.steps_per_day)
+        night_array = np.zeros(total_steps, dtype='bool')
+        night_array[bin_idx[in_range & night]] = True
+        night_array = night_array.reshape(self.total_days, self.steps_per_day)
+        day_array = np.zeros(total_steps, dtype='bool')
+        day_array[bin_idx[in_range & ~night]] = True
+        day_array = day_array.reshape(self.total_days, self.steps_per_day)
         # If at some step there are both night and day data points, keep only one
         #night_array[day_array] = False # Option a)
         day_array[night_array] = False # Option b)
@@ -533,11 +731,15 @@ class CycleAnalyzer():
         # Positive pattern values correspont to night while negative pattern values correspont to day.
         #   Zero values correspond to no available data and they will be filled during next stage.
         # In case of conflicting day/night values create new day/night pattern.
+        # Days without any data points can't conflict with the current pattern and don't change it
+        has_data = np.any(night_array | day_array, axis=1)
         for d in range(self.total_days):
+            if not has_data[d]:
+                pattern_days[-1] += 1
             # Check that night and day phases for current day are not overlapping with phases in current pattern
-            if np.any((day_pattern & night_array[d]) | (night_pattern & day_array[d])):
+            elif (day_pattern & night_array[d]).any() or (night_pattern & day_array[d]).any():
                 # If night/day phases overlap with current pattern, finalize pattern and start new one.
-                patterns.append(night_pattern.astype('int') - day_pattern.astype('int'))
+                patterns.append(night_pattern.astype('int8') - day_pattern.astype('int8'))
                 pattern_days.append(1)
                 day_pattern = day_array[d].copy()
                 night_pattern = night_array[d].copy()
@@ -548,28 +750,33 @@ class CycleAnalyzer():
                 pattern_days[-1] += 1
         else:
             # Append last day/night pattern
-            patterns.append(night_pattern.astype('int') - day_pattern.astype('int'))
+            patterns.append(night_pattern.astype('int8') - day_pattern.astype('int8'))
         # Fill unassigned values in patterns and determine day/night boundaries
         # "Pretty" time values (in minutes) that will be favoured for day/night boundaries.
         pretty_numbers = [60, 30, 15, 10, 5]
-        pretty_numbers = [n // self.step.astype('int') for n in pretty_numbers if n % self.step.astype('int') == 0]
+        pretty_numbers = [n // self.__step_minutes for n in pretty_numbers if n % self.__step_minutes == 0]
         # Alignment to the one step is always valid
         if not pretty_numbers or pretty_numbers[-1] != 1:
             pretty_numbers.append(1)
         start_offset = ((self.start - self.__t0) % self.__day) // self.step
+        # For each step of a day, the nearest preceding steps aligned to each of the pretty numbers
+        #   (in the same order), so boundaries are aligned by lookups instead of repeated modulo
+        day_steps = np.arange(self.steps_per_day)
+        aligned_steps = (day_steps - (day_steps + start_offset) % np.reshape(pretty_numbers, (-1, 1))).T.tolist()
         pattern_start = 0
-        boundaries = np.zeros(self.steps_per_day, dtype='int')
-        nighttime = np.zeros(self.steps_per_day, dtype='int')
+        # Patterns only hold -1, 0 and 1, while these count days
+        boundaries = np.zeros(self.steps_per_day, dtype='int32')
+        nighttime = np.zeros(self.steps_per_day, dtype='int32')
         for pattern, ndays in zip(patterns, pattern_days):
             start_idx = 0
             last_idx = 0
             last_val = 0
-            for i in np.nonzero(pattern)[0]:
+            for i in np.flatnonzero(pattern):
                 if pattern[i] == -last_val:
                     # Try to align boundaries to "pretty" values
-                    for n in pretty_numbers:
-                        if i - (i + start_offset) % n > last_idx - 1:
-                            last_idx = i - (i + start_offset) % n
+                    for aligned_idx in aligned_steps[i]:
+                        if aligned_idx > last_idx - 1:
+                            last_idx = aligned_idx
                             break
                     pattern[start_idx : last_idx] = last_val
                     start_idx = last_idx
@@ -580,13 +787,14 @@ class CycleAnalyzer():
                     last_idx = i + 1
             else:
                 pattern[start_idx : ] = last_val
+            # The pattern is broadcast over all of its days, without tiling it into a temporary array
             self.__night[pattern_start * self.steps_per_day :
-                         (pattern_start + ndays) * self.steps_per_day] = np.tile(pattern > 0, ndays)
+                         (pattern_start + ndays) * self.steps_per_day].reshape(ndays, -1)[:] = pattern > 0
             pattern_start += ndays
             # We are interested only in night -> day borders, that's why less-than-zero condition
             boundaries += (np.diff(pattern, prepend=pattern[-1]) < 0) * ndays
             nighttime += (pattern > 0)*ndays
-        boundary_idx = np.nonzero(boundaries)[0]
+        boundary_idx = np.flatnonzero(boundaries)
         if boundary_idx.size > 0:
             # This sorting order prioritizes daytime over presense of night/day borders at the start of each day
             boundary_idx = boundary_idx[np.lexsort((-boundaries[boundary_idx], nighttime[boundary_idx]))][0]
@@ -598,16 +806,24 @@ class CycleAnalyzer():
         self.start += boundary_idx * self.step
         self.stop += boundary_idx * self.step
         start_idx = boundary_idx
-        stop_idx = start_idx + self.total_days * self.steps_per_day
-        # Extend data by 1 day because the shift in start position
+        # Shift data by start_idx steps, the steps past the end have no activity and repeat night of the last day
         if start_idx > 0:
-            self.__timestamps = np.append(self.__timestamps,
-                                          np.arange(self.__day, step=self.step)
-                                          + self.__timestamps[-1] + self.step)[start_idx : stop_idx]
-            self.__activity = np.append(self.__activity,
-                                        np.zeros(self.steps_per_day, dtype='int'))[start_idx : stop_idx]
-            self.__night = np.append(self.__night,
-                                     self.__night[-self.steps_per_day : ])[start_idx : stop_idx]
+            total_steps = self.__timestamps.size
+            kept = total_steps - start_idx
+            self.__timestamps = np.arange(self.start, self.stop, self.step)
+            shifted_activity = np.zeros(total_steps, dtype=self.__activity.dtype)
+            shifted_activity[:kept] = self.__activity[start_idx:]
+            self.__activity = shifted_activity
+            shifted_night = np.empty(total_steps, dtype='bool')
+            shifted_night[:kept] = self.__night[start_idx:]
+            last_day = total_steps - self.steps_per_day
+            shifted_night[kept:] = self.__night[last_day : last_day + start_idx]
+            self.__night = shifted_night
+
+        # Integer offsets (in minutes) of bins from the start, used instead of datetime arithmetic
+        self.__offsets = (self.__timestamps - self.start).astype('int64')
+        # Bouts depend only on activity and bout parameters, so they are memoized by those parameters
+        self.__bouts_cache = {}
 
         # Mask out datapoints for inactive days
         self.daily_mask = np.ones(self.total_days, dtype='bool')
@@ -676,7 +892,7 @@ class CycleAnalyzer():
         if step is None:
             step = self.step
         else:
-            step = pd.Timedelta(step).asm8.astype('<m8[m]')
+            step = _to_minutes(step)
         if self.__day % step:
             raise ValueError(f"there should be whole number of steps in 1 day")
         steps_per_day = self.__day // step
@@ -703,42 +919,83 @@ class CycleAnalyzer():
 
     def __discretize(self, weights, step):
         step, steps_per_day = self.__get_step(step)
-        result, intervals = np.histogram(self.timestamps,
-                                         np.arange(self.start, self.stop + step, step, dtype='<M8[m]'),
-                                         weights=weights)
+        if step % self.step == self.__zero:
+            # Each bin covers a whole number of instance steps (and days are whole numbers of bins),
+            #   so binning is just summation of consecutive values
+            ratio = step // self.step
+            if ratio == 1:
+                return weights, self.timestamps
+            result = weights.reshape(-1, ratio).sum(axis=1)
+            return (result.astype(weights.dtype, copy=False), self.timestamps[::ratio])
+        intervals = np.arange(self.start, self.stop, step, dtype='<M8[m]')
+        # Bins are uniform, so bin indices are found by integer division instead of binary search
+        result = np.bincount(self.__offsets[self.__mask] // step.astype('int64'), weights=weights,
+                             minlength=intervals.size)
         mask = np.repeat(self.daily_mask, steps_per_day)
-        return (result[mask], intervals[:-1][mask])
+        return (result[mask].astype(weights.dtype, copy=False), intervals[mask])
+
+
+    def __binned(self, step, bouts=False):
+        # Binned activity (or bouts) is reused by several methods, so it's calculated once for
+        #   each step and cached until the daily mask or the bouts are updated.
+        #   The cached arrays are read-only.
+        step, _ = self.__get_step(step)
+        if (step, bouts) not in self.__binned_cache:
+            values, timestamps = self.__discretize(self.bouts if bouts else self.activity, step)
+            values.flags.writeable = False
+            timestamps.flags.writeable = False
+            self.__binned_cache[(step, bouts)] = (values, timestamps)
+        return self.__binned_cache[(step, bouts)]
 
 
     def __activity_bouts(self, max_gap=None, min_duration=None, min_activity=None):
         if max_gap is None:
             max_gap = self.max_gap
         else:
-            max_gap = pd.Timedelta(max_gap).asm8.astype('<m8[m]')
+            max_gap = _to_minutes(max_gap)
             if max_gap % self.step != self.__zero:
                 raise ValueError(f"max_gap should be multiple of discretization step ({str(self.step)})")
         if min_duration is None:
             min_duration = self.min_duration
         else:
-            min_duration = pd.Timedelta(min_duration).asm8.astype('<m8[m]')
+            min_duration = _to_minutes(min_duration)
             if min_duration % self.step != self.__zero:
                 raise ValueError(f"min_duration should be multiple of discretization step ({str(self.step)})")
         if min_activity is None:
             min_activity = self.min_activity
         max_gap = max_gap // self.step
         min_duration = min_duration // self.step
-        bouts = np.zeros_like(self.__activity, dtype='bool')
-        indexes = np.nonzero(self.__activity >= min_activity)[0]
+        key = (int(max_gap), int(min_duration), min_activity)
+        if key not in self.__bouts_cache:
+            bouts = self.__find_bouts(*key)
+            bouts.setflags(write=False)
+            self.__bouts_cache[key] = bouts
+        return self.__bouts_cache[key]
+
+
+    def __find_bouts(self, max_gap, min_duration, min_activity):
+        indexes = np.flatnonzero(self.__activity >= min_activity)
         if len(indexes) > 0:
-            bout_starts = indexes[(np.diff(indexes, prepend=indexes[0] - max_gap - 1) > max_gap).nonzero()[0]]
-            bout_ends = indexes[(np.diff(indexes, append=indexes[0] + max_gap + 1) > max_gap).nonzero()[0]] + 1
+            # Gaps between consecutive active bins are calculated once and used for both bout
+            #   starts (bins after a gap) and bout ends (bins before a gap)
+            gaps = np.diff(indexes) > max_gap
+            bout_starts = indexes[np.concatenate(([True], gaps))]
+            # The last active bin only ends a bout if it is the only one, which keeps the old
+            #   behaviour of dropping a bout that lasts until the end of the series
+            bout_ends = indexes[np.concatenate((gaps, [len(indexes) == 1]))] + 1
         else:
-            bout_starts = np.zeros(0)
-            bout_ends = np.zeros(0)
-        for s, e in zip(bout_starts, bout_ends):
-            if e - s >= min_duration:
-                bouts[s:e] = True
-        return bouts.astype('int')
+            bout_starts = np.zeros(0, dtype='int')
+            bout_ends = np.zeros(0, dtype='int')
+        # Starts and ends are paired up the same way zip() would pair them
+        n_bouts = min(bout_starts.size, bout_ends.size)
+        bout_starts = bout_starts[:n_bouts]
+        bout_ends = bout_ends[:n_bouts]
+        long_bouts = bout_ends - bout_starts >= min_duration
+        # Mark each bout with +1 at its start and -1 after its end, so the running sum is 1 inside bouts
+        delta = np.zeros(self.__activity.size + 1, dtype='int')
+        delta[bout_starts[long_bouts]] += 1
+        delta[bout_ends[long_bouts]] -= 1
+        return np.cumsum(delta[:-1])
 
 
     def activity_bouts(self, max_gap=None, min_duration=None, min_activity=None):
@@ -784,7 +1041,7 @@ class CycleAnalyzer():
         :param min_activity: Overrides ``self.min_activity`` if specified.
         """
         if max_gap:
-            max_gap = pd.Timedelta(max_gap).asm8.astype('<m8[m]')
+            max_gap = _to_minutes(max_gap)
             if max_gap < self.step:
                 max_gap = self.step
             elif max_gap % self.step != self.__zero:
@@ -793,7 +1050,7 @@ class CycleAnalyzer():
         else:
             max_gap = self.max_gap
         if min_duration:
-            min_duration = pd.Timedelta(min_duration).asm8.astype('<m8[m]')
+            min_duration = _to_minutes(min_duration)
             if min_duration < self.step:
                 min_duration = self.step
             elif min_duration % self.step != self.__zero:
@@ -808,6 +1065,7 @@ class CycleAnalyzer():
         else:
             min_activity = self.min_activity
         self.__bouts = self.__activity_bouts(max_gap, min_duration, min_activity)
+        self.__binned_cache = {}
 
 
     def filter_inactive(self, min_data_points=1):
@@ -818,13 +1076,35 @@ class CycleAnalyzer():
             defaults to ``1``.
             Days with fewer data points (records) are filtered out.
         """
-        self.daily_mask[:] = False
-        self.__mask[:] = False
-        events, _ = np.histogram(self.__timestamps[self.__activity > 0],
-                                 np.arange(self.start, self.stop + self.__day, self.__day))
+        # Data is aligned to calendar days, so the number of data points per day is a row-wise count
+        events = np.count_nonzero(self.__activity.reshape(self.total_days, self.steps_per_day) > 0, axis=1)
         self.daily_mask = (events >= min_data_points)
-        self.days = self.daily_mask.sum()
+        self.days = np.count_nonzero(self.daily_mask)
         self.__mask = np.repeat(self.daily_mask, self.steps_per_day)
+        # Dates of the remaining days, used for labeling daily plots
+        self.__dates = (self.start + np.flatnonzero(self.daily_mask) * self.__day).astype('datetime64[D]')
+        self.__binned_cache = {}
+
+
+    def clear_cache(self):
+        """Drop memoized binned data and activity bouts.
+
+        Cached results are reused by metrics and plots called with the same parameters
+        and are normally invalidated automatically.
+        Call this method after modifying analyzer data by other means.
+        """
+        self.__binned_cache = {}
+        self.__bouts_cache = {}
+
+
+    def __daily_ticks(self, max_ticks):
+        # Every tick_step-th day and the last day are labeled
+        tick_step = self.days // (max_ticks - 1) + 1
+        tick_pos = np.arange(0, self.days, tick_step)
+        if tick_pos[-1] != self.days - 1:
+            tick_pos = np.append(tick_pos, self.days - 1)
+        tick_labels = self.__dates[tick_pos]
+        return tick_pos, tick_labels
 
 
     def plot_actogram(self, step=None, bouts=False, log=False, activity_onset='step', percentile=20, N='6h', M='6h',
@@ -892,23 +1172,22 @@ class CycleAnalyzer():
         #bar_color = '#40444B'
         #night_color = '#CACFE2'
         onset_color = '#cc0000'
-        if bouts:
-            if step != self.step:
-                values, timestamps = self.__discretize(self.bouts, step)
-            else:
-                values = self.bouts
-                timestamps = self.timestamps
+        if step != self.step:
+            values, timestamps = self.__binned(step, bouts)
         else:
-            if step != self.step:
-                values, timestamps = self.__discretize(self.activity, step)
-            else:
-                values = self.activity
-                timestamps = self.timestamps
+            values = self.bouts if bouts else self.activity
+            timestamps = self.timestamps
         if log:
+            # Binned values may be shared with other methods, so they are not modified in place
+            values = values.copy()
             values[values>1] = 1 + np.log(values[values>1])
         values = values.reshape(self.days, steps_per_day)
-        night, _ = self.__discretize(self.night.astype('int'), step)
-        night = (night>0).astype('int').reshape(self.days, steps_per_day)
+        if step != self.step:
+            # A bin is night if any of its steps is night
+            night, _ = self.__discretize(self.night, step)
+        else:
+            night = self.night
+        night = night.reshape(self.days, steps_per_day)
         max_y = values.max()
         plots_height = height*self.days
         total_height = plots_height + 150
@@ -928,33 +1207,43 @@ class CycleAnalyzer():
             tick_start = (self.__hour - minute_offset) / self.__day
         hours_per_tick = 2
         tick_pos = np.arange(tick_start, 1 + tick_start, hours_per_tick/24) * steps_per_day
-        tick_labels = []
-        for i in range(len(tick_pos)):
-            tick_label = pd.Timestamp(first_tick + i*hours_per_tick*self.__hour).strftime('%H')
-            tick_labels.append(tick_label)
+        # Hours of the ticks and dates of the days are formatted all at once
+        tick_hours = ((first_tick - self.__t0) // self.__hour + np.arange(len(tick_pos)) * hours_per_tick) % 24
+        tick_labels = [f"{h:02d}" for h in tick_hours]
+        day_labels = np.datetime_as_string(timestamps[::steps_per_day], unit='D')
         fig.text(0.5, 1 - 50/total_height, f"Actogram {self.descr}", ha='center', fontsize=20, wrap=False)
         if activity_onset:
             onset = self.activity_onset(step, percentile, N, M, bouts, activity_onset)
-            onset = ((onset - timestamps[0]) % self.__day) / self.__day * steps_per_day
+            onset = ((onset - timestamps[0]).astype('int64') % self.__day_minutes
+                     / self.__day_minutes * steps_per_day)
+        # Starts and ends (in steps) of night intervals of all days are found at once, night intervals
+        #   of day d are at night_pos[night_split[d]:night_split[d+1]]
+        night_days, night_pos = np.nonzero(np.diff(night, axis=1, prepend=False, append=False))
+        night_pos = night_pos.astype('float').reshape(-1, 2)
+        night_split = np.concatenate(([0], np.cumsum(np.bincount(night_days[::2], minlength=self.days))))
         last_d = -1
-        interval = np.arange(steps_per_day)
+        # Activity of a day is drawn as a single step-shaped polygon and its nights as a single collection
+        #   of full-height spans instead of one artist per bar and per span
+        interval = np.arange(steps_per_day + 1)
+        span_y = np.array([0, 1, 1, 0])
         for i in range(1, 2*self.days):
             d = i // 2
             if d != last_d:
-                night_pos = timestamps[np.nonzero(np.diff(night[d],
-                                                          prepend=False, append=False))[0]].reshape(-1, 2)
-                night_pos = ((night_pos - timestamps[0]) / self.__day) * steps_per_day
+                day_night_pos = night_pos[night_split[d] : night_split[d+1]]
+                night_verts = np.stack((day_night_pos[:, [0, 0, 1, 1]],
+                                        np.broadcast_to(span_y, (len(day_night_pos), 4))), axis=-1)
+                heights = np.append(values[d], values[d, -1])
             last_d = d
             ax = subplots[d - (i+1)%2, (i+1) % 2]
-            ax.bar(interval, values[d], width=1, align='edge', color=bar_color)
-            for j in range(len(night_pos)):
-                ax.axvspan(night_pos[j, 0], night_pos[j, 1], color=night_color, alpha=0.5)
+            ax.fill_between(interval, heights, step='post', facecolor=bar_color, linewidth=0)
+            ax.add_collection(PolyCollection(night_verts, color=night_color, alpha=0.5,
+                                             transform=ax.get_xaxis_transform()), autolim=False)
             if not i%2:
                 ax.yaxis.set_label_position('right')
             if activity_onset:
                 ax.axvspan(onset[d], onset[d], color=onset_color)
             ax.set_yticks([])
-            ax.set_ylabel(f"{pd.Timestamp(timestamps[d*steps_per_day]).strftime('%Y-%m-%d')}",
+            ax.set_ylabel(day_labels[d],
                           rotation=0, fontsize=8, labelpad=40, va='center')
         plt.xticks(ticks=tick_pos, labels=tick_labels)
         plt.xlim([0, steps_per_day])
@@ -997,23 +1286,33 @@ class CycleAnalyzer():
             ``powers`` is the corresponding periodogram powers for each period.
         """
         step, _ = self.__get_step(step)
-        min_period = pd.Timedelta(min_period).asm8.astype('<m8[m]')
-        max_period = pd.Timedelta(max_period).asm8.astype('<m8[m]')
+        min_period = _to_minutes(min_period)
+        max_period = _to_minutes(max_period)
         if min_period % step + max_period % step != self.__zero:
                 raise ValueError(f"min_period and max_period should be divisible "
                                  f"by step ({pd.Timedelta(step)})")
-        if bouts:
-            values, _ = self.__discretize(self.bouts, step)
-        else:
-            values, _ = self.__discretize(self.activity, step)
-        # Pad zeros to not lose values at the end of data
-        values = np.pad(values, (0, max_period//step - 1))
+        values, _ = self.__binned(step, bouts)
         n = values.size
-        result = np.zeros(max_period//step - min_period//step + 1)
-        for i, p in enumerate(np.arange(min_period//step, max_period//step + 1)):
-            k = n//p
-            tmp = values[:k*p].reshape((k, p))
-            result[i] = k*p*tmp.mean(axis=0).var() / tmp.var()
+        # Running sums give the total variance of any prefix without another pass over the data
+        #   (they are exact for integer values)
+        sums = np.cumsum(values)
+        sq_sums = np.cumsum(values * values)
+        p = np.arange(min_period//step, max_period//step + 1)
+        # Data is treated as if padded with zeros to not lose values at the end of data,
+        #   but the padding is never materialized: only the last (partial) row is affected
+        k = (n + max_period//step - 1)//p
+        used = np.minimum(k*p, n)
+        # Sum of squared column sums is the only per-period pass over the data,
+        #   everything else is calculated for all periods at once
+        col_sq_sums = np.zeros(p.size)
+        for i in range(p.size):
+            full = used[i] - used[i] % p[i]
+            col_sums = values[:full].reshape((-1, p[i])).sum(axis=0)
+            col_sums[:used[i] - full] += values[full:used[i]]
+            col_sq_sums[i] = np.dot(col_sums, col_sums)
+        total = sums[used - 1] / (k*p)
+        total_var = sq_sums[used - 1] / (k*p) - total * total
+        result = k*p*(col_sq_sums / (k*k*p) - total * total) / total_var
         periods = np.arange(min_period, max_period + step, step, dtype='<m8[m]')
         return periods, result
 
@@ -1107,13 +1406,11 @@ class CycleAnalyzer():
 
             ``auc_val`` is the area under the curve (integral).
         """
-        result = np.zeros(self.total_days)
-        if bouts:
-            day_activity, _ = self.__discretize(self.bouts.astype('int') * ~self.night, self.__day)
-            all_activity, _ = self.__discretize(self.bouts.astype('int'), self.__day)
-        else:
-            day_activity, _ = self.__discretize(self.activity * ~self.night, self.__day)
-            all_activity, _ = self.__discretize(self.activity, self.__day)
+        values = (self.bouts if bouts else self.activity).reshape(self.days, self.steps_per_day)
+        # Filtered data consists of whole calendar days, so daily sums are row sums
+        #   (light phase values are summed in place rather than through a masked copy)
+        day_activity = values.sum(axis=1, where=~self.night.reshape(self.days, self.steps_per_day))
+        all_activity = values.sum(axis=1)
         result = day_activity / all_activity
         mean_result = day_activity.sum() / all_activity.sum()
         if auc:
@@ -1153,13 +1450,7 @@ class CycleAnalyzer():
             filename = Path(filename)
         fig = plt.figure(figsize=(width/dpi, height/dpi))
         #plt.ylim(0, 1)
-        tick_step = self.days // (max_ticks - 1) + 1
-        tick_mask = np.full(self.days, False, dtype='bool')
-        for i in range(0, self.days, tick_step):
-            tick_mask[i] = True
-        tick_mask[-1] = True
-        tick_pos = np.arange(self.days)[tick_mask]
-        tick_labels = np.arange(self.start, self.stop, self.__day)[self.daily_mask][tick_mask].astype('datetime64[D]')
+        tick_pos, tick_labels = self.__daily_ticks(max_ticks)
         plt.xticks(tick_pos, tick_labels, rotation=90)
         plt.plot(values, color=graph_color)
         plt.axhline(total, color=total_color)
@@ -1193,10 +1484,7 @@ class CycleAnalyzer():
         :return: Number from 0 to 1 (inclusive).
         """
         step, steps_per_day = self.__get_step(step)
-        if bouts:
-            values, _ = self.__discretize(self.bouts, step)
-        else:
-            values, _ = self.__discretize(self.activity, step)
+        values, _ = self.__binned(step, bouts)
         values = values.reshape(self.days, steps_per_day)
         result = 0.0
         var = values.var()
@@ -1235,20 +1523,19 @@ class CycleAnalyzer():
             ``auc_val`` is the area under the curve (integral).
         """
         step, steps_per_day = self.__get_step(step)
-        if bouts:
-            values, _ = self.__discretize(self.bouts, step)
-        else:
-            values, _ = self.__discretize(self.activity, step)
+        values, _ = self.__binned(step, bouts)
         values = values.reshape(self.days, steps_per_day)
         result = np.zeros(self.days)
-        tmp = (np.diff(values, axis=-1) ** 2).mean(axis=-1)
-        var = values.reshape(self.days, steps_per_day).var(axis=-1)
+        # Squared successive differences are shared by the daily values and the total
+        sq_diff = np.diff(values, axis=-1) ** 2
+        tmp = sq_diff.mean(axis=-1)
+        var = values.var(axis=-1)
         mask = (var > 0) & ~np.isnan(var)
         result[mask] = tmp[mask] / var[mask]
         total = 0.0
         var = values.var()
         if var and not np.isnan(var):
-            total = (np.diff(values) ** 2).mean() / var
+            total = sq_diff.mean() / var
         if auc:
             return result, total, self.__auc(result, 1)
         else:
@@ -1290,13 +1577,7 @@ class CycleAnalyzer():
         if filename is not None:
             filename = Path(filename)
         fig = plt.figure(figsize=(width/dpi, height/dpi))
-        tick_step = self.days // (max_ticks - 1) + 1
-        tick_mask = np.full(self.days, False, dtype='bool')
-        for i in range(0, self.days, tick_step):
-            tick_mask[i] = True
-        tick_mask[-1] = True
-        tick_pos = np.arange(self.days)[tick_mask]
-        tick_labels = np.arange(self.start, self.stop, self.__day)[self.daily_mask][tick_mask].astype('datetime64[D]')
+        tick_pos, tick_labels = self.__daily_ticks(max_ticks)
         plt.xticks(tick_pos, tick_labels, rotation=90)
         #plt.ylim(0, max(total, values.max())*1.05)
         plt.plot(values, color=graph_color)
@@ -1335,11 +1616,8 @@ class CycleAnalyzer():
             ``auc_val`` is the area under the curve (integral).
         """
 
-        def window1d(a, width, step=1):
-            return a[np.arange(0, width, step)[None, :] + np.arange(0, a.size-width+1, step)[:, None]]
-
-        most_active = pd.Timedelta(most_active).asm8
-        least_active = pd.Timedelta(least_active).asm8
+        most_active = _to_timedelta(most_active)
+        least_active = _to_timedelta(least_active)
         if most_active + least_active + min(most_active, least_active) > self.__day:
             raise ValueError(f"most_active + least_active + min(most_active, least_active) "
                              "should be no greater than 1 day")
@@ -1357,49 +1635,46 @@ class CycleAnalyzer():
             values = self.activity
         most_active_steps = most_active // self.step
         least_active_steps = least_active // self.step
-        result = np.zeros(self.days)
-        total_most_active = 0
-        total_least_active = 0
-        for i in range(self.days):
-            start = i * self.steps_per_day
-            stop = (i+1) * self.steps_per_day
-            most_active_w = window1d(values[start : stop], most_active_steps).mean(-1)
-            most_active_idx = most_active_w.argmax()
-            most_active_val = most_active_w[most_active_idx]
-            least_active_val_1 = np.inf
-            least_active_val_2 = np.inf
-            if most_active_idx >= least_active_steps:
-                least_active_w = window1d(values[start : start + most_active_idx],
-                                          least_active_steps).mean(-1)
-                least_active_idx = least_active_w.argmin()
-                least_active_val_1 = least_active_w[least_active_idx]
-            if most_active_idx + most_active_steps + least_active_steps <= self.steps_per_day:
-                least_active_w = window1d(values[start + most_active_idx + most_active_steps : stop],
-                                          least_active_steps).mean(-1)
-                least_active_idx = least_active_w.argmin()
-                least_active_val_2 = least_active_w[least_active_idx]
-            least_active_val = min(least_active_val_1, least_active_val_2)
-            if least_active_val == np.inf:
-                least_active_w = window1d(values[start : stop], least_active_steps).mean(-1)
-                least_active_idx = least_active_w.argmin()
-                least_active_val = least_active_w[least_active_idx]
-                most_active_val_1 = -np.inf
-                most_active_val_2 = -np.inf
-                if least_active_idx >= most_active_steps:
-                    most_active_w = window1d(values[start : start + least_active_idx],
-                                             most_active_steps).mean(-1)
-                    most_active_idx = most_active_w.argmax()
-                    most_active_val_1 = most_active_w[most_active_idx]
-                if least_active_idx + least_active_steps + most_active_steps <= self.steps_per_day:
-                    most_active_w = window1d(values[start + least_active_idx + least_active_steps : stop],
-                                             most_active_steps).mean(-1)
-                    most_active_idx = most_active_w.argmax()
-                    most_active_val_2 = most_active_w[most_active_idx]
-                most_active_val = max(most_active_val_1, most_active_val_2)
-            total_most_active += most_active_val
-            total_least_active += least_active_val
-            if most_active_val:
-                result[i] = (most_active_val - least_active_val) / (most_active_val + least_active_val)
+        # Running sums over the whole data are shared by windows of both widths
+        sums = np.concatenate(([0], np.cumsum(values)))
+
+        steps_per_day = self.steps_per_day
+        day_starts = np.arange(self.days).reshape(-1, 1) * steps_per_day
+        days = np.arange(self.days)
+
+        def window_means(width):
+            # Means of all windows that fit into a day, one row per day, read straight from the running sums
+            starts = day_starts + np.arange(steps_per_day - width + 1)
+            return (sums[starts + width] - sums[starts]) / width
+
+        most_active_w = window_means(most_active_steps)
+        least_active_w = window_means(least_active_steps)
+
+        def around(idx, width, other_width):
+            # Mask of windows of other_width that fit entirely before or entirely after the window at idx
+            pos = np.arange(steps_per_day - other_width + 1)
+            idx = idx.reshape(-1, 1)
+            return (pos <= idx - other_width) | (pos >= idx + width)
+
+        # All days are processed at once: the least active window is searched before and after the most
+        #   active one, and the windows that don't fit are excluded by +inf (or -inf) values.
+        most_active_idx = most_active_w.argmax(axis=1)
+        most_active_val = most_active_w[days, most_active_idx]
+        least_active_val = np.where(around(most_active_idx, most_active_steps, least_active_steps),
+                                    least_active_w, np.inf).min(axis=1)
+        # If there is no room for the least active window then the most active window is searched
+        #   around the least active one instead.
+        swap = least_active_val == np.inf
+        if swap.any():
+            least_active_idx = least_active_w[swap].argmin(axis=1)
+            least_active_val[swap] = least_active_w[swap].min(axis=1)
+            most_active_val[swap] = np.where(around(least_active_idx, least_active_steps, most_active_steps),
+                                             most_active_w[swap], -np.inf).max(axis=1)
+        total_most_active = most_active_val.sum()
+        total_least_active = least_active_val.sum()
+        # Days without activity keep zero amplitude
+        result = np.divide(most_active_val - least_active_val, most_active_val + least_active_val,
+                           out=np.zeros(self.days), where=most_active_val != 0)
         total = 0.0
         if total_most_active:
             total = (total_most_active - total_least_active) / (total_most_active + total_least_active)
@@ -1445,13 +1720,7 @@ class CycleAnalyzer():
         if filename is not None:
             filename = Path(filename)
         fig = plt.figure(figsize=(width/dpi, height/dpi))
-        tick_step = self.days // (max_ticks - 1) + 1
-        tick_mask = np.full(self.days, False, dtype='bool')
-        for i in range(0, self.days, tick_step):
-            tick_mask[i] = True
-        tick_mask[-1] = True
-        tick_pos = np.arange(self.days)[tick_mask]
-        tick_labels = np.arange(self.start, self.stop, self.__day)[self.daily_mask][tick_mask].astype('datetime64[D]')
+        tick_pos, tick_labels = self.__daily_ticks(max_ticks)
         plt.xticks(tick_pos, tick_labels, rotation=90)
         #plt.ylim(0, 1)
         plt.plot(np.arange(self.days), values, color=graph_color)
@@ -1491,12 +1760,15 @@ class CycleAnalyzer():
             ``bout_durations`` is the average activity bout durations for each day \
                 in minutes.
         """
-        bouts = self.activity_bouts(max_gap, min_duration, min_activity).reshape(self.days,
-                                                                              self.steps_per_day).astype('int')
-        bout_counts = (np.diff(bouts, prepend=0, append=0, axis=-1) > 0).sum(axis=-1)
+        # Filtered out days are dropped as whole rows rather than step by step
+        bouts = self.__activity_bouts(max_gap, min_duration, min_activity).reshape(self.total_days,
+                                                                                   self.steps_per_day)
+        bouts = bouts[self.daily_mask]
+        # Bouts start at the steps where bouts change from 0 to 1 and at the first step of a day
+        bout_counts = bouts[:, 0] + np.count_nonzero(bouts[:, 1:] > bouts[:, :-1], axis=-1)
         bout_durations = np.zeros(self.days, dtype='float')
         mask = (bout_counts > 0)
-        bout_durations[mask] = self.step.astype('int') * bouts.sum(axis=-1)[mask] / bout_counts[mask]
+        bout_durations[mask] = self.__step_minutes * bouts.sum(axis=-1)[mask] / bout_counts[mask]
         return bout_counts, bout_durations
 
 
@@ -1536,13 +1808,7 @@ class CycleAnalyzer():
         if filename is not None:
             filename = Path(filename)
         fig = plt.figure(figsize=(width/dpi, height/dpi))
-        tick_step = self.days // (max_ticks - 1) + 1
-        tick_mask = np.full(self.days, False, dtype='bool')
-        for i in range(0, self.days, tick_step):
-            tick_mask[i] = True
-        tick_mask[-1] = True
-        tick_pos = np.arange(self.days)[tick_mask]
-        tick_labels = np.arange(self.start, self.stop, self.__day)[self.daily_mask][tick_mask].astype('datetime64[D]')
+        tick_pos, tick_labels = self.__daily_ticks(max_ticks)
         plt.xticks(tick_pos, tick_labels, rotation=90)
         plt.ylabel('N. bouts', fontsize=12)
         plt.bar(np.arange(self.days), bout_counts, color=bar_color)
@@ -1587,10 +1853,9 @@ class CycleAnalyzer():
         :type dpi: int, optional
         :param dpi: Plot resolution, defaults to 100.
         """
-        bouts = self.activity_bouts(max_gap, min_duration, min_activity).astype('int')
-        bout_starts = np.nonzero(np.diff(bouts, prepend=0, append=0, axis=-1) > 0)[0]
-        bout_ends = np.nonzero(np.diff(bouts, prepend=0, append=0, axis=-1) < 0)[0]
-        values = (bout_ends - bout_starts) * self.step.astype('int')
+        # Bout boundaries are taken from a single difference of the (cached) bouts
+        edges = np.diff(self.activity_bouts(max_gap, min_duration, min_activity), prepend=0, append=0)
+        values = (np.flatnonzero(edges < 0) - np.flatnonzero(edges > 0)) * self.__step_minutes
         graph_color = '#404040'
         if filename is not None:
             filename = Path(filename)
@@ -1679,13 +1944,10 @@ class CycleAnalyzer():
                 activity onset), not relative shifts from the start of the day.
         """
         step, steps_per_day = self.__get_step(step)
-        if bouts:
-            values, timestamps = self.__discretize(self.bouts, step)
-        else:
-            values, timestamps = self.__discretize(self.activity, step)
+        values, timestamps = self.__binned(step, bouts)
         values = values.reshape(self.days, steps_per_day)
-        N = pd.Timedelta(N).asm8.astype('<m8[m]') // step
-        M = pd.Timedelta(M).asm8.astype('<m8[m]') // step
+        N = _to_minutes(N) // step
+        M = _to_minutes(M) // step
         if mode == 'step':
             left = np.full(N, -1)
             right = np.full(M, 1)
@@ -1702,20 +1964,33 @@ class CycleAnalyzer():
             raise ValueError(f'unrecognized mode')
         # If M != N, pad zeros to keep discontinuity at the center of kernel
         kernel = np.concatenate((np.zeros(max(M - N, 0)), left, right, np.zeros(max(N - M, 0))))
-        result = np.zeros(self.days, dtype='<M8[m]')
-        for d in range(self.days):
-            tmp = values[d]
-            if tmp.max() > 0:
-                active = tmp >= np.percentile(tmp[tmp > 0], percentile, interpolation='higher')
-            else:
-                active = np.zeros(0, dtype='int')
-            tmp[:] = -1
-            tmp[active] = 1
-            tmp = np.pad(tmp, steps_per_day, mode='constant', constant_values=-1)
-            t = np.correlate(tmp, kernel, mode='same')[steps_per_day : 2 * steps_per_day]
-            idx = steps_per_day - t[::-1].argmax() - 1
-            result[d] = timestamps[d * steps_per_day + idx]
-        return result
+        if not 0 <= percentile <= 100:
+            raise ValueError(f"percentile should be in range [0, 100]")
+        if self.days == 0:
+            return np.zeros(0, dtype='<M8[m]')
+        days = np.arange(self.days)
+        # Steps with activity not less than the percentile (the 'higher' value) of non-zero activity in the day
+        #   are active (+1) and the rest are inactive (-1); days without any activity are inactive.
+        nonzero = np.count_nonzero(values > 0, axis=1)
+        sorted_values = np.sort(np.where(values > 0, values, np.inf), axis=1)
+        threshold_idx = np.ceil(percentile / 100 * (np.maximum(nonzero, 1) - 1)).astype('int')
+        thresholds = np.where(nonzero > 0, sorted_values[days, threshold_idx], np.inf)
+        signs = np.where(values >= thresholds.reshape(-1, 1), 1, -1)
+        # Each day is correlated with the kernel as if it was padded with one day of inactive steps on
+        #   both sides (and zeros further away). Days are stacked with only as much padding as the kernel
+        #   reaches, so a single 'valid' correlation covers all days.
+        left = kernel.size // 2
+        right = kernel.size - 1 - left
+        row_size = left + steps_per_day + right
+        # Padded rows share the kernel dtype, so np.correlate works on them without a cast copy
+        padded = np.full((self.days, row_size), -1, dtype=kernel.dtype)
+        padded[:, : max(left - steps_per_day, 0)] = 0
+        padded[:, row_size - max(right - steps_per_day, 0) :] = 0
+        padded[:, left : left + steps_per_day] = signs
+        t = np.correlate(padded.ravel(), kernel, mode='valid')
+        t = np.concatenate((t, np.zeros(kernel.size - 1))).reshape(self.days, row_size)[:, : steps_per_day]
+        idx = steps_per_day - t[:, ::-1].argmax(axis=1) - 1
+        return timestamps[days * steps_per_day + idx]
 
 
     def plot_activity_onset(self, step=None, percentile=20, N='6h', M='6h', bouts=False, mode='step',
@@ -1783,19 +2058,13 @@ class CycleAnalyzer():
         :param dpi: Plot resolution, defaults to 100.
         """
         values = self.activity_onset(step, percentile, N, M, bouts, mode)
-        values = ((values - self.__t0) % self.__day) / self.__hour
+        values = (values.astype('<M8[m]').view('int64') % self.__day_minutes) / self.__hour_minutes
         fig = plt.figure(figsize=(width/dpi, height/dpi))
         plt.ylim(-1, 24)
         max_ticks = 20
         if filename is not None:
             filename = Path(filename)
-        tick_step = self.days // (max_ticks - 1) + 1
-        tick_mask = np.full(self.days, False, dtype='bool')
-        for i in range(0, self.days, tick_step):
-            tick_mask[i] = True
-        tick_mask[-1] = True
-        tick_pos = np.arange(self.days)[tick_mask]
-        tick_labels = np.arange(self.start, self.stop, self.__day)[self.daily_mask][tick_mask].astype('datetime64[D]')
+        tick_pos, tick_labels = self.__daily_ticks(max_ticks)
         plt.xticks(tick_pos, tick_labels, rotation=90)
         plt.plot(values)
         fig.text(0.5, 0.95, f"Activity Onset {self.descr}", ha='center', fontsize=20, wrap=False)
@@ -1842,8 +2111,8 @@ def generate_data(points_per_day=100, days=10, activity_period='24h', night_peri
     """
     rng = np.random.default_rng()
     start = pd.Timestamp('2020-01-01').asm8.astype('<M8[m]')
-    activity_period = pd.Timedelta(activity_period).asm8.astype('<m8[m]')
-    night_period = pd.Timedelta(night_period).asm8.astype('<m8[m]')
+    activity_period = _to_minutes(activity_period)
+    night_period = _to_minutes(night_period)
     minute = np.timedelta64(1, 'm')
     nbursts = rng.integers(1, 3, endpoint=True)
     activity_bursts = rng.integers(activity_period.astype('i8'), size=nbursts).astype('<m8[m]')
@@ -1883,7 +2152,7 @@ def generate_night(timeseries, night_period='24h'):
     ''' Generate a random ``is_night`` array.
 
     :type timeseries: np.array[np.datetime64]
-    :param timeseries: Timestamps of measurements.
+    :param timeseries: Timestamps of measurements sorted in ascending order.
 
     :type night_period: str|int|timedelta, optional
     :param night_period: Period of night, defualts to ``'24h'``.
@@ -1894,26 +2163,22 @@ def generate_night(timeseries, night_period='24h'):
 
     '''
     rng = np.random.default_rng()
-    night_period = pd.Timedelta(night_period).asm8.astype('<m8[m]')
-    is_night = np.ones(timeseries.size, dtype='bool')
+    night_period = _to_minutes(night_period)
     start = timeseries[0]
     stop = timeseries[-1]
-    step = pd.Timedelta('5m').asm8
+    step = np.timedelta64(5, 'm')
     nsteps = night_period / step
-    d0 = pd.Timedelta(0).asm8
+    d0 = np.timedelta64(0, 'm')
     marks = []
     while d0 < night_period:
         d1 = min(d0 + rng.integers(1, 100, endpoint=True) * step, night_period)
         marks.append([d0, d1])
         d0 = d1 + rng.integers(1, 100, endpoint=True) * step
     marks = np.array(marks)
-    t0 = start
-    t1 = t0 + marks[0, 1]
-    mark_it = cycle(np.diff(marks, axis=0, append=(marks[0] + night_period).reshape(1, -1)))
-    while t0 <= stop:
-        indices = np.nonzero((timeseries >= t0) & (timeseries < t1))
-        is_night[indices] = False
-        d0, d1 = next(mark_it)
-        t0 = t0 + d0
-        t1 = t1 + d1
-    return is_night
+    # Daytime intervals of each night period starting from the first timestamp, enough periods to cover
+    #   the last timestamp
+    periods = np.arange((stop - start) // night_period + 1) * night_period
+    edges = (start + marks + periods.reshape(-1, 1, 1)).ravel()
+    # Daytime intervals are sorted and don't overlap, so a timestamp belongs to daytime
+    #   if and only if an odd number of interval edges are not greater than it
+    return np.searchsorted(edges, timeseries, side='right') % 2 == 0
@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+
+from chronobiology.chronobiology import CycleAnalyzer
+
+
+def _hourly(*days):
+    # One record at the start of every hour, with the given hourly activity for each day
+    activity = np.concatenate(days)
+    timestamps = np.datetime64('2020-01-01', 'm') + np.arange(activity.size) * np.timedelta64(60, 'm')
+    return CycleAnalyzer(timestamps, activity, step='1h')
+
+
+@pytest.mark.parametrize('mode', ['step', 'linear', 'quadratic', 'sine'])
+def test_activity_onset(mode):
+    # Inactive night, then 12 active hours starting at 08:00 (and at 14:00 for steps above the median)
+    data = _hourly([0]*8 + [5]*12 + [0]*4, [0]*8 + [1]*6 + [9]*6 + [0]*4)
+    onsets = data.activity_onset(mode=mode)
+    assert onsets.tolist() == np.array(['2020-01-01T08:00', '2020-01-02T08:00'], dtype='<M8[m]').tolist()
+    onsets = data.activity_onset(percentile=50, mode=mode)
+    assert onsets.tolist() == np.array(['2020-01-01T08:00', '2020-01-02T14:00'], dtype='<M8[m]').tolist()
+    # Kernel parts of different lengths keep the discontinuity at the same place
+    onsets = data.activity_onset(N='4h', M='8h', percentile=50, mode=mode)
+    assert onsets.tolist() == np.array(['2020-01-01T08:00', '2020-01-02T14:00'], dtype='<M8[m]').tolist()
+    onsets = data.activity_onset(step='2h', mode=mode)
+    assert onsets.tolist() == np.array(['2020-01-01T08:00', '2020-01-02T08:00'], dtype='<M8[m]').tolist()
+
+
+@pytest.mark.parametrize('N, M', [('6h', '6h'), ('4h', '8h'), ('8h', '4h')])
+def test_activity_onset_at_day_edges(N, M):
+    # Days are padded with inactive steps, so activity at the start of a day is an onset, and
+    #   activity until the end of a day has its onset where it begins
+    data = _hourly([3]*6 + [0]*18, [0]*18 + [3]*6)
+    onsets = data.activity_onset(N=N, M=M)
+    assert onsets.tolist() == np.array(['2020-01-01T00:00', '2020-01-02T18:00'], dtype='<M8[m]').tolist()
+
+
+def test_relative_amplitude():
+    # 10h/5h windows: the least active window fits around the most active one on all days
+    data = _hourly([1]*9 + [10]*6 + [2]*9, [1]*8 + [10]*10 + [1]*6, [5]*5 + [0]*5 + [10]*10 + [5]*4)
+    daily, total = data.relative_amplitude('10h', '5h')
+    # Most active: 6.8 (09:00-19:00), 10 and 10, least active: 1, 1 and 0 (05:00-10:00, right
+    #   before the most active window)
+    assert daily == pytest.approx([5.8 / 7.8, 9 / 11, 1])
+    assert total == pytest.approx(24.8 / 28.8)
+
+
+def test_relative_amplitude_swapped_search():
+    # 6h/12h windows: the most active window starts too late for a 12h window before it and too
+    #   early for one after it, so the most active window is searched around the least active one
+    data = _hourly([1]*9 + [10]*6 + [2]*9, [1]*8 + [10]*10 + [1]*6)
+    daily, total = data.relative_amplitude('6h', '12h')
+    # Least active: 3.25 and 4 (00:00-12:00), most active after it: 6 and 10 (12:00-18:00)
+    assert daily == pytest.approx([2.75 / 9.25, 6 / 14])
+    assert total == pytest.approx(8.75 / 23.25)
+
+
+def test_relative_amplitude_without_activity():
+    data = _hourly([0]*24, [1]*8 + [10]*10 + [1]*6)
+    daily, total = data.relative_amplitude('10h', '5h')
+    # Days without activity are filtered out by default
+    assert daily == pytest.approx([9 / 11])
+    data.filter_inactive(min_data_points=0)
+    daily, total = data.relative_amplitude('10h', '5h')
+    assert daily == pytest.approx([0, 9 / 11])
+    assert total == pytest.approx(9 / 11)
+
+
+def _periodogram(values, min_steps, max_steps):
+    # Straightforward periodogram with explicit zero padding at the end of data
+    values = np.pad(values, (0, max_steps - 1))
+    result = []
+    for p in range(min_steps, max_steps + 1):
+        k = values.size // p
+        rows = values[: k * p].reshape((k, p))
+        result.append(k * p * rows.mean(axis=0).var() / rows.var())
+    return np.array(result)
+
+
+def test_periodogram():
+    # 12 active hours every 24 hours
+    data = _hourly(*[[10]*12 + [0]*12] * 4)
+    periods, powers = data.periodogram(step='1h', min_period='20h', max_period='28h')
+    assert periods.tolist() == (np.arange(20, 29) * np.timedelta64(60, 'm')).tolist()
+    assert periods[powers.argmax()] == np.timedelta64(24, 'h')
+    # 96 values and an all-zero row of padding in 5 rows of 24 columns: 120 * (32 - 16) / 24
+    assert powers[4] == pytest.approx(80)
+    assert powers == pytest.approx(_periodogram(data.activity, 20, 28))
+
+
+@pytest.mark.parametrize('step', ['1h', '2h'])
+def test_periodogram_irregular(step):
+    # Rows are padded (virtually) with a different number of zeros for each period
+    rng = np.random.default_rng(0)
+    activity = rng.integers(0, 20, 24 * 5) * np.tile(np.r_[np.ones(14), np.zeros(10)], 5)
+    data = _hourly(activity)
+    steps = 2 if step == '2h' else 1
+    periods, powers = data.periodogram(step=step, min_period='16h', max_period='32h')
+    assert powers == pytest.approx(_periodogram(activity.reshape(-1, steps).sum(axis=1), 16 // steps, 32 // steps))
+    # Float activity is not summed exactly, but stays close to the direct calculation
+    data = _hourly(activity + 0.1)
+    periods, powers = data.periodogram(step=step, min_period='16h', max_period='32h')
+    assert powers == pytest.approx(_periodogram((activity + 0.1).reshape(-1, steps).sum(axis=1),
+                                                16 // steps, 32 // steps))
+
+
+def test_binning():
+    timestamps = np.array(['2020-01-01T00:00', '2020-01-01T00:30', '2020-01-01T01:10', '2020-01-01T23:59',
+                           '2020-01-02T00:00', '2020-01-02T05:00'], dtype='<M8[m]')
+    data = CycleAnalyzer(timestamps, np.array([1, 2, 3, 4, 5, 6]), step='1h', stop='2020-01-02')
+    assert (data.start, data.stop) == (np.datetime64('2020-01-01T00:00'), np.datetime64('2020-01-02T00:00'))
+    # Like np.histogram, the last bin includes records at its right edge, later records are dropped
+    assert data.activity.tolist() == [3, 3] + [0]*21 + [9]
+    assert data.activity.dtype == np.dtype('int64')
+    assert data.timestamps.tolist() == (np.datetime64('2020-01-01', 'm')
+                                        + np.arange(24) * np.timedelta64(60, 'm')).tolist()
+    # Records before start are dropped as well
+    data = CycleAnalyzer(timestamps, np.array([1., 2., 3., 4., 5., 6.5]), step='2h', start='2020-01-02')
+    assert data.activity.tolist() == [5, 0, 6.5] + [0]*9
+    assert data.activity.dtype == np.dtype('float64')
+
+
+def test_binning_nanoseconds():
+    # Records are binned by their exact time, not by their time rounded to minutes
+    timestamps = np.datetime64('2020-01-01T00:00', 'ns') + np.array([0, 3599_999_999_999, 3600_000_000_000,
+                                                                     86399_999_999_999])
+    data = CycleAnalyzer(timestamps, step='1h')
+    assert data.activity.tolist() == [2, 1] + [0]*21 + [1]
+
+
+def test_day_boundary_shift():
+    # Nights from 00:00 to 06:00: the data is shifted so that it starts at the night -> day boundary
+    night = np.arange(48) % 24 < 6
+    timestamps = np.datetime64('2020-01-01', 'm') + np.arange(48) * np.timedelta64(60, 'm')
+    data = CycleAnalyzer(timestamps, np.arange(1, 49), night=night, step='1h')
+    assert (data.start, data.stop) == (np.datetime64('2020-01-01T06:00'), np.datetime64('2020-01-03T06:00'))
+    assert data.timestamps[0] == data.start and data.timestamps.size == 48
+    # Steps shifted past the end of data have no activity and repeat the night of the last day
+    assert data.activity.tolist() == list(range(7, 49)) + [0]*6
+    assert data.night.tolist() == ([False]*18 + [True]*6) * 2
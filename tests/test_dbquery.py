@@ -0,0 +1,93 @@
+import io
+import json
+
+import msgpack
+import numpy as np
+import pytest
+import requests
+from influxdb.exceptions import InfluxDBClientError
+
+from chronobiology.chronobiology import DBQuery
+
+
+def _fake_db(*payloads):
+    # DBQuery whose HTTP session answers every request with the given payloads instead of
+    #   connecting to a server, so requests still go through InfluxDBClient.request().
+    #   Like InfluxDB, the fake server sends chunks as back-to-back msgpack documents if msgpack
+    #   is accepted and as JSON lines otherwise. Keyword arguments of all requests and all
+    #   responses are collected in the returned lists.
+    db = DBQuery('db', 'user', 'password')
+    sent, responses = [], []
+
+    def request(method, url, **kwargs):
+        sent.append(kwargs)
+        response = requests.Response()
+        response.status_code = 200
+        if kwargs['headers'].get('Accept') == 'application/x-msgpack':
+            response.headers['Content-Type'] = 'application/x-msgpack'
+            body = b''.join(msgpack.packb(payload) for payload in payloads)
+        else:
+            response.headers['Content-Type'] = 'application/json'
+            body = b''.join(json.dumps(payload).encode() + b'\n' for payload in payloads)
+        response.raw = io.BytesIO(body)
+        responses.append(response)
+        return response
+
+    db.client._session.request = request
+    return db, sent, responses
+
+
+def _series(columns, values):
+    return {'results': [{'statement_id': 0,
+                         'series': [{'name': 'series', 'columns': columns, 'values': values}]}]}
+
+
+def test_string_type_without_schema():
+    db, sent, _ = _fake_db(_series(['time', 'value', 'site'],
+                                    [[0, 1.5, 'A1'], [60_000_000_000, 2.5, 'B2']]))
+    data = db.get_data('series', {'value': 'float', 'site': 'string'})
+    # All types are given, so only the SELECT is sent
+    assert len(sent) == 1
+    assert data['time'].dtype == np.dtype('<M8[ns]')
+    assert data['value'].dtype == np.dtype('float64')
+    assert data['site'].dtype == np.dtype('<U2')
+    assert data['site'].tolist() == ['A1', 'B2']
+
+
+def test_chunks_are_streamed_as_json():
+    db, sent, _ = _fake_db(_series(['time', 'value'], [[0, 1.5], [60_000_000_000, 2.5]]),
+                           _series(['time', 'value'], [[120_000_000_000, 3.5]]))
+    data = db.get_data('series', {'value': 'float'})
+    # A chunked msgpack body can't be unpacked as a single document, so JSON is requested
+    assert sent[0]['headers']['Accept'] == 'application/json'
+    assert sent[0]['params']['chunked'] == 'true'
+    assert data['value'].tolist() == [1.5, 2.5, 3.5]
+    assert data['time'].tolist() == np.array([0, 60, 120], dtype='<M8[s]').astype('<M8[ns]').tolist()
+
+
+def test_statement_error_in_chunked_response():
+    # InfluxDB reports errors of a statement in the result with HTTP 200
+    db, _, responses = _fake_db({'results': [{'statement_id': 0,
+                                              'error': 'invalid operation: time and *influxql.StringLiteral '
+                                                       'are not compatible'}]})
+    with pytest.raises(InfluxDBClientError, match='not compatible'):
+        db.get_data('series', {'value': 'float'}, start='2020-01-01')
+    assert responses[0].raw.closed
+
+
+def test_error_after_first_chunk():
+    db, _, responses = _fake_db(_series(['time', 'value'], [[0, 1.5]]), {'error': 'max-select-point limit exceeded'})
+    with pytest.raises(InfluxDBClientError, match='limit exceeded'):
+        db.get_data('series', {'value': 'float'})
+    # The streamed response is closed even though it was not read to the end
+    assert responses[0].raw.closed
+
+
+def test_missing_column_in_select_all():
+    db, sent, _ = _fake_db(_series(['time', 'site', 'value'], [[0, 'A1', 1.5], [60_000_000_000, 'B2', 2.5]]))
+    db._schema_cache['series'] = (('site',), ('value', 'temp'), ('float', 'float'))
+    data = db.get_data('series', '*')
+    assert sent[0]['params']['q'].startswith('SELECT * ')
+    # 'temp' has no values in the queried shards, so the server doesn't return the column
+    assert data['value'].tolist() == [1.5, 2.5]
+    assert np.isnan(data['temp']).all() and len(data['temp']) == 2